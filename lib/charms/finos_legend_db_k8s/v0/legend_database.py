@@ -1,7 +1,25 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
-"""Module defining Legend DB consumer class and helpers."""
+"""Module defining Legend DB consumer class and helpers.
+
+The Legend DB relation data holds one of two representations of the creds:
+    * v0: the original flat JSON dict under `LEGEND_DB_RELATION_DATA_KEY`.
+    * v1: a versioned payload under `LEGEND_DB_RELATION_PAYLOAD_KEY` which
+      can carry multiple endpoints (primary, read, analytics) and driver
+      options. Its revision counter is also set under
+      `LEGEND_DB_RELATION_REVISION_KEY` and is incremented every time the
+      payload's contents change, so consumers can skip deserializing
+      unchanged data by comparing it. Non-primary endpoints omit their URI
+      when it is the same as the primary endpoint's and inherit it instead,
+      so they usually only hold their specific driver options.
+
+The version is negotiated over the relation: `LegendDatabaseConsumer`
+publishes the versions it supports in its application data under
+`LEGEND_DB_RELATION_VERSIONS_KEY`, and the provider picks the highest version
+supported by both sides using `get_negotiated_payload_version()`. Consumers
+which do not publish any versions are assumed to only support v0.
+"""
 
 import json
 import logging
@@ -16,12 +34,23 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 3
+LIBPATCH = 4
 
 LEGEND_DB_RELATION_DATA_KEY = "legend-db-connection"
 REQUIRED_LEGEND_DATABASE_CREDENTIALS = [
     "username", "password", "database", "uri"]
 
+LEGEND_DB_RELATION_PAYLOAD_KEY = "legend-db-payload"
+LEGEND_DB_RELATION_REVISION_KEY = "legend-db-payload-revision"
+LEGEND_DB_RELATION_VERSIONS_KEY = "legend-db-payload-versions"
+LEGEND_DB_PAYLOAD_VERSION = 1
+# NOTE: version 0 represents the flat creds under `LEGEND_DB_RELATION_DATA_KEY`:
+SUPPORTED_LEGEND_DB_PAYLOAD_VERSIONS = [0, LEGEND_DB_PAYLOAD_VERSION]
+
+LEGEND_DB_PRIMARY_ENDPOINT = "primary"
+LEGEND_DB_READ_ENDPOINT = "read"
+LEGEND_DB_ANALYTICS_ENDPOINT = "analytics"
+
 logger = logging.getLogger(__name__)
 
 
@@ -119,6 +148,195 @@ def set_legend_database_creds_in_relation_data(relation_data, creds):
     return True
 
 
+def get_negotiated_payload_version(consumer_relation_data):
+    """Returns the highest payload version supported by both relation sides.
+
+    Args:
+        consumer_relation_data: Application data of the consumer side of the
+            relation, where `LegendDatabaseConsumer` publishes its versions.
+
+    Returns:
+        The payload version to pass to
+        `set_legend_database_payload_in_relation_data()`. Defaults to 0 if
+        the consumer does not publish any (valid) versions.
+    """
+    versions_data = consumer_relation_data.get(LEGEND_DB_RELATION_VERSIONS_KEY)
+    if not versions_data:
+        return 0
+    try:
+        consumer_versions = json.loads(versions_data)
+    except Exception as ex:
+        logger.warning(
+            "Could not deserialize Legend DB consumer payload versions: %s. "
+            "Error was: %s", versions_data, str(ex))
+        return 0
+    if not isinstance(consumer_versions, list):
+        logger.warning(
+            "Legend DB consumer payload versions must be a list, not: %s",
+            consumer_versions)
+        return 0
+    # NOTE: bools are ints too, and unhashable elements would break the set:
+    consumer_versions = [
+        v for v in consumer_versions
+        if isinstance(v, int) and not isinstance(v, bool)]
+    common_versions = set(consumer_versions).intersection(
+        SUPPORTED_LEGEND_DB_PAYLOAD_VERSIONS)
+    return max(common_versions, default=0)
+
+
+def set_legend_database_payload_in_relation_data(
+        relation_data, creds, endpoints=None, options=None,
+        version=LEGEND_DB_PAYLOAD_VERSION):
+    """Set the Legend DB creds in the provided relation data.
+
+    Depending on the given version, either the v0 flat creds or the
+    versioned payload is set, and the other representation is removed. The
+    relation data is only modified if all the arguments are valid. The
+    payload's revision is incremented every time its contents change, and
+    is removed along with the payload when switching to version 0, in which
+    case it restarts from 1 if version 1 is set again.
+
+    Args:
+        relation_data: Data of the relation to set the info into.
+        creds: Legend DB creds as returned by
+            `get_database_connection_from_mongo_data()`.
+        endpoints: Optional dict mapping endpoint names (e.g.
+            `LEGEND_DB_READ_ENDPOINT`) to dicts with a "uri" and optional
+            "options" dict of driver options specific to the endpoint.
+            The primary endpoint defaults to the URI in the creds. Other
+            endpoints may omit their "uri" to inherit the primary's, and
+            it is omitted from the payload if it is the same anyway.
+        options: Optional dict of driver options for all endpoints.
+        version: Payload version to set, as returned by
+            `get_negotiated_payload_version()`. Endpoints and options are
+            not shared with consumers of version 0.
+
+    Returns:
+        True if the provided creds, endpoints and version are valid, else
+        False.
+    """
+    if version not in SUPPORTED_LEGEND_DB_PAYLOAD_VERSIONS:
+        logger.warning("Unsupported Legend DB payload version: %s", version)
+        return False
+    if not _validate_legend_database_credentials(creds):
+        return False
+
+    endpoints = dict(endpoints or {})
+    endpoints.setdefault(LEGEND_DB_PRIMARY_ENDPOINT, {"uri": creds["uri"]})
+    payload = {
+        "version": LEGEND_DB_PAYLOAD_VERSION,
+        "username": creds["username"],
+        "password": creds["password"],
+        "database": creds["database"],
+        "endpoints": _compact_legend_database_endpoints(endpoints),
+        "options": options or {}}
+    if not _validate_legend_database_payload(dict(payload, revision=0)):
+        logger.warning("Invalid Legend DB payload: %s", payload)
+        return False
+
+    if version == 0:
+        relation_data.pop(LEGEND_DB_RELATION_PAYLOAD_KEY, None)
+        relation_data.pop(LEGEND_DB_RELATION_REVISION_KEY, None)
+        return set_legend_database_creds_in_relation_data(relation_data, creds)
+
+    relation_data.pop(LEGEND_DB_RELATION_DATA_KEY, None)
+    revision = _get_legend_database_revision(relation_data) or 0
+    try:
+        current_payload = json.loads(
+            relation_data.get(LEGEND_DB_RELATION_PAYLOAD_KEY, "{}"))
+    except Exception:
+        current_payload = {}
+    if isinstance(current_payload, dict):
+        current_payload.pop("revision", None)
+        if current_payload == payload:
+            return True
+    payload["revision"] = revision + 1
+
+    relation_data[LEGEND_DB_RELATION_PAYLOAD_KEY] = json.dumps(
+        payload, separators=(",", ":"), sort_keys=True)
+    relation_data[LEGEND_DB_RELATION_REVISION_KEY] = str(payload["revision"])
+    return True
+
+
+def _compact_legend_database_endpoints(endpoints):
+    """Returns the endpoints without the URIs equal to the primary's."""
+    primary_endpoint = endpoints[LEGEND_DB_PRIMARY_ENDPOINT]
+    if not isinstance(primary_endpoint, dict):
+        return endpoints
+    res = {}
+    for name, endpoint in endpoints.items():
+        if name != LEGEND_DB_PRIMARY_ENDPOINT and isinstance(endpoint, dict) and (
+                endpoint.get("uri") == primary_endpoint.get("uri")):
+            endpoint = {k: v for k, v in endpoint.items() if k != "uri"}
+        res[name] = endpoint
+    return res
+
+
+def _get_legend_database_revision(relation_data):
+    """Returns the payload revision from the relation data or None."""
+    try:
+        return int(relation_data.get(LEGEND_DB_RELATION_REVISION_KEY))
+    except (TypeError, ValueError):
+        return None
+
+
+def _load_legend_database_payload(relation_data):
+    """Returns the versioned payload from the relation data.
+
+    Returns an empty dict if there is no payload, it is invalid or of a
+    version which this library does not support. Endpoints which inherit the
+    primary endpoint's URI have it filled in.
+    """
+    payload_data = relation_data.get(LEGEND_DB_RELATION_PAYLOAD_KEY)
+    if not payload_data:
+        return {}
+    try:
+        payload = json.loads(payload_data)
+    except Exception as ex:
+        logger.warning(
+            "Could not deserialize Legend DB payload JSON: %s. Error "
+            "was: %s", payload_data, str(ex))
+        return {}
+    if not _validate_legend_database_payload(payload):
+        logger.warning("Invalid Legend DB payload in relation: %s", payload)
+        return {}
+    endpoints = payload["endpoints"]
+    for endpoint in endpoints.values():
+        endpoint.setdefault("uri", endpoints[LEGEND_DB_PRIMARY_ENDPOINT]["uri"])
+    return payload
+
+
+def _validate_legend_database_payload(payload):
+    """Checks whether the given payload is of a supported version and structure."""
+    if not isinstance(payload, dict):
+        return False
+    if payload.get("version") != LEGEND_DB_PAYLOAD_VERSION:
+        return False
+    if not isinstance(payload.get("revision"), int):
+        return False
+    if any([not isinstance(payload.get(k), str) for k in ["username", "password", "database"]]):
+        return False
+    if not isinstance(payload.get("options"), dict):
+        return False
+    return _validate_legend_database_endpoints(payload.get("endpoints"))
+
+
+def _validate_legend_database_endpoints(endpoints):
+    """Checks whether the given payload endpoints are of a valid structure."""
+    if not isinstance(endpoints, dict) or LEGEND_DB_PRIMARY_ENDPOINT not in endpoints:
+        return False
+    if not isinstance(endpoints[LEGEND_DB_PRIMARY_ENDPOINT], dict) or not isinstance(
+            endpoints[LEGEND_DB_PRIMARY_ENDPOINT].get("uri"), str):
+        return False
+    for endpoint in endpoints.values():
+        # NOTE: non-primary endpoints may omit their URI to inherit the primary's:
+        if not isinstance(endpoint, dict) or not isinstance(endpoint.get("uri", ""), str):
+            return False
+        if not isinstance(endpoint.get("options", {}), dict):
+            return False
+    return True
+
+
 def _validate_legend_database_credentials(creds):
     """Checks whether the given legend DB creds contain all required keys."""
     if not isinstance(creds, dict) or any([
@@ -133,6 +351,105 @@ class LegendDatabaseConsumer(framework.Object):
         super().__init__(charm, relation_name)
         self.charm = charm
         self.relation_name = relation_name
+        self.framework.observe(
+            charm.on[relation_name].relation_created, self._on_relation_created)
+        self.framework.observe(charm.on.leader_elected, self._on_leader_elected)
+
+    def _on_relation_created(self, event):
+        self._publish_supported_payload_versions(event.relation)
+
+    def _on_leader_elected(self, _):
+        for relation in self.framework.model.relations[self.relation_name]:
+            self._publish_supported_payload_versions(relation)
+
+    def _publish_supported_payload_versions(self, relation):
+        """Publishes the supported payload versions in the application data."""
+        if not self.charm.unit.is_leader():
+            return
+        # NOTE: only the requiring side of the relation is a consumer:
+        if self.charm.meta.relations[self.relation_name].role.name != "requires":
+            return
+        relation.data[self.charm.app][LEGEND_DB_RELATION_VERSIONS_KEY] = json.dumps(
+            SUPPORTED_LEGEND_DB_PAYLOAD_VERSIONS)
+
+    def _get_relation_data(self, relation_id):
+        """Returns the provider's data from the given relation or None."""
+        relation = self.framework.model.get_relation(
+            self.relation_name, relation_id)
+        if not relation:
+            logger.warning(
+                "No relation of name '%s' and ID '%s' was found.",
+                self.relation_name, relation_id)
+            return None
+        return relation.data[relation.app]
+
+    def get_legend_database_revision(self, relation_id):
+        """Get the revision of the versioned payload from the provided relation.
+
+        This does not deserialize the payload, so it is cheap enough for
+        consumers to compare it against the last revision they processed on
+        every hook.
+
+        Args:
+            relation_id: ID of the relation to fetch data from.
+
+        Returns:
+            The revision as an int, or None if the provider does not set a
+            versioned payload.
+        """
+        relation_data = self._get_relation_data(relation_id)
+        if relation_data is None:
+            return None
+        return _get_legend_database_revision(relation_data)
+
+    def get_legend_database_payload(self, relation_id):
+        """Get the versioned Legend DB payload from the provided relation.
+
+        Falls back to the v0 creds if the provider does not set a payload of
+        a version supported by this library (e.g. providers which predate
+        version negotiation), in which case the payload will have a version
+        and revision of 0 and only a primary endpoint. Endpoints which
+        inherit the primary endpoint's URI in the relation data have it
+        filled in, so every returned endpoint has a "uri".
+
+        Args:
+            relation_id: ID of the relation to fetch data from.
+
+        Returns:
+            Dictionary with the following structure:
+            {
+                "version": <payload version>,
+                "revision": <payload revision>,
+                "username": "<username>",
+                "password": "<password>",
+                "database": "<database name>",
+                "endpoints": {
+                    "primary": {"uri": "<URI>", "options": {...}},
+                    "read": {"uri": "<URI>", "options": {...}},
+                    "analytics": {"uri": "<URI>", "options": {...}}
+                },
+                "options": {<driver options for all endpoints>}
+            }
+        """
+        relation_data = self._get_relation_data(relation_id)
+        if relation_data is None:
+            return {}
+
+        payload = _load_legend_database_payload(relation_data)
+        if payload:
+            return payload
+
+        creds = self._load_legend_database_creds(relation_data)
+        if not creds:
+            return {}
+        return {
+            "version": 0,
+            "revision": 0,
+            "username": creds["username"],
+            "password": creds["password"],
+            "database": creds["database"],
+            "endpoints": {LEGEND_DB_PRIMARY_ENDPOINT: {"uri": creds["uri"]}},
+            "options": {}}
 
     def get_legend_database_creds(self, relation_id):
         """Get connection data for MongoDB from the provided relation.
@@ -153,15 +470,21 @@ class LegendDatabaseConsumer(framework.Object):
             TooManyRelatedAppsError if relation id is not provided and
             multiple relation of the same name are present.
         """
-        relation = self.framework.model.get_relation(
-            self.relation_name, relation_id)
-        if not relation:
-            logger.warning(
-                "No relation of name '%s' and ID '%s' was found.",
-                self.relation_name, relation_id)
+        relation_data = self._get_relation_data(relation_id)
+        if relation_data is None:
             return {}
-        relation_data = relation.data[relation.app]
 
+        payload = _load_legend_database_payload(relation_data)
+        if payload:
+            return {
+                "uri": payload["endpoints"][LEGEND_DB_PRIMARY_ENDPOINT]["uri"],
+                "username": payload["username"],
+                "password": payload["password"],
+                "database": payload["database"]}
+        return self._load_legend_database_creds(relation_data)
+
+    def _load_legend_database_creds(self, relation_data):
+        """Returns the v0 creds from the given relation data."""
         creds_data = relation_data.get(LEGEND_DB_RELATION_DATA_KEY, "{}")
         try:
             creds = json.loads(creds_data)
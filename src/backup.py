@@ -0,0 +1,463 @@
+# Copyright 2021 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Module defining helpers for streaming backups of the Legend database.
+
+Backups are written as one compressed file of newline-delimited canonical
+MongoDB Extended JSON documents per collection, alongside a `manifest.json`
+which records the compression used, the document counts and the index
+definitions of every collection, as well as the definitions of any views.
+Canonical Extended JSON preserves the BSON types of all values (e.g. Int64 or
+Decimal128) across a backup and restore. All data is streamed between the database and the
+workload container in fixed-size chunks, so memory usage does not depend on
+the size of the collections.
+"""
+
+import gzip
+import io
+import logging
+import posixpath
+import time
+import zlib
+
+import pymongo
+from bson import json_util
+from pymongo import errors
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_FILE_EXTENSIONS = {
+    COMPRESSION_GZIP: "jsonl.gz",
+    COMPRESSION_ZSTD: "jsonl.zst",
+}
+BACKUP_MANIFEST_FILENAME = "manifest.json"
+BACKUP_MANIFEST_VERSION = 1
+DEFAULT_BATCH_SIZE = 1000
+STREAM_CHUNK_SIZE = 1024 * 1024
+# NOTE: MongoDB error code for duplicate key errors:
+DUPLICATE_KEY_ERROR_CODE = 11000
+JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS
+
+
+class BackupError(Exception):
+    """Raised when a backup or restore operation cannot be carried out."""
+
+
+class _ChunkStreamReader(io.RawIOBase):
+    """Read-only file-like object over an iterator of `bytes` chunks.
+
+    Keeps at most one pending chunk in memory, which is read through a
+    `memoryview` to avoid copying it on every read, and counts the bytes read.
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b"")
+        self._offset = 0
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._pending):
+            try:
+                self._pending = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self._offset = 0
+        size = min(len(buffer), len(self._pending) - self._offset)
+        start, end = self._offset, self._offset + size
+        buffer[:size] = self._pending[start:end]
+        self._offset = end
+        self.bytes_read += size
+        return size
+
+
+class _CountingReader(io.RawIOBase):
+    """Read-only file-like object counting the bytes read from `fileobj`."""
+
+    def __init__(self, fileobj):
+        super().__init__()
+        self._fileobj = fileobj
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._fileobj.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self.bytes_read += size
+        return size
+
+
+def _get_zstandard_module():
+    """Returns the `zstandard` module or raises a `BackupError` if unavailable."""
+    try:
+        import zstandard
+    except ImportError as ex:
+        raise BackupError("zstd compression requires the 'zstandard' package") from ex
+    return zstandard
+
+
+def _compress_chunks(chunks, compression):
+    """Yields the compressed form of the given iterator of `bytes` chunks."""
+    if compression == COMPRESSION_GZIP:
+        # NOTE: wbits=31 selects the gzip container format:
+        compressor = zlib.compressobj(wbits=31)
+    elif compression == COMPRESSION_ZSTD:
+        compressor = _get_zstandard_module().ZstdCompressor().compressobj()
+    else:
+        raise BackupError("unsupported compression: %s" % compression)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _open_decompressed(fileobj, compression):
+    """Returns a buffered binary reader over the decompressed `fileobj`."""
+    if compression == COMPRESSION_GZIP:
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if compression == COMPRESSION_ZSTD:
+        reader = _get_zstandard_module().ZstdDecompressor().stream_reader(fileobj)
+        return io.BufferedReader(reader, STREAM_CHUNK_SIZE)
+    raise BackupError("unsupported compression: %s" % compression)
+
+
+def _iter_collection_chunks(collection, batch_size, stats):
+    """Yields the documents of a collection as newline-delimited JSON chunks.
+
+    Documents are fetched in cursor batches of `batch_size` and each batch is
+    yielded as a single chunk. The "documents" count in `stats` is updated
+    as the documents are read.
+    """
+    batch = []
+    for document in collection.find(batch_size=batch_size):
+        batch.append(json_util.dumps(document, json_options=JSON_OPTIONS))
+        if len(batch) >= batch_size:
+            stats["documents"] += len(batch)
+            yield ("\n".join(batch) + "\n").encode("utf-8")
+            batch = []
+    if batch:
+        stats["documents"] += len(batch)
+        yield ("\n".join(batch) + "\n").encode("utf-8")
+
+
+def _get_collection_indexes(collection):
+    """Returns a list of the index definitions of a collection, minus `_id`."""
+    indexes = []
+    for name, info in collection.index_information().items():
+        if name == "_id_":
+            continue
+        options = {k: v for k, v in info.items() if k not in ("key", "v", "ns")}
+        options["name"] = name
+        indexes.append({"keys": [list(key) for key in info["key"]], "options": options})
+    return indexes
+
+
+def _get_views(database):
+    """Returns a list of the definitions of the views within the database."""
+    views = []
+    for info in database.list_collections(filter={"type": "view"}):
+        views.append({"name": info["name"], "options": dict(info.get("options", {}))})
+    return sorted(views, key=lambda view: view["name"])
+
+
+def _restore_view(database, view, drop):
+    """Creates a view from its definition recorded in a backup manifest.
+
+    Returns whether the view was created, views which already exist are
+    left untouched unless `drop` is set.
+    """
+    if drop:
+        database.drop_collection(view["name"])
+    try:
+        database.create_collection(view["name"], **view["options"])
+    except errors.CollectionInvalid:
+        logger.info("View '%s' already exists, skipping it", view["name"])
+        return False
+    return True
+
+
+def _get_mongo_client(legend_database_creds):
+    """Returns a `pymongo.MongoClient` for the given Legend DB creds."""
+    return pymongo.MongoClient(legend_database_creds["uri"])
+
+
+def _get_transfer_stats(byte_count, start_time):
+    """Returns the size, duration and throughput of a transfer as action results."""
+    duration = max(time.monotonic() - start_time, 1e-6)
+    return {
+        "bytes": byte_count,
+        "duration": "%.3f" % duration,
+        "bytes-per-second": int(byte_count / duration),
+    }
+
+
+def _backup_collection(collection, container, backup_path, compression, batch_size):
+    """Streams a single collection into a compressed file within the container.
+
+    Returns a tuple of the manifest entry for the collection and the number
+    of compressed bytes written.
+    """
+    filename = "%s.%s" % (collection.name, COMPRESSION_FILE_EXTENSIONS[compression])
+    stats = {"documents": 0}
+    reader = _ChunkStreamReader(
+        _compress_chunks(_iter_collection_chunks(collection, batch_size, stats), compression)
+    )
+    container.push(posixpath.join(backup_path, filename), reader, encoding=None, make_dirs=True)
+    logger.debug(
+        "Backed up %d documents (%d bytes) from collection '%s'",
+        stats["documents"],
+        reader.bytes_read,
+        collection.name,
+    )
+
+    manifest_entry = {
+        "name": collection.name,
+        "file": filename,
+        "documents": stats["documents"],
+        "indexes": _get_collection_indexes(collection),
+    }
+    return manifest_entry, reader.bytes_read
+
+
+def backup_database(
+    legend_database_creds,
+    container,
+    backup_path,
+    compression=COMPRESSION_GZIP,
+    batch_size=DEFAULT_BATCH_SIZE,
+):
+    """Streams a compressed backup of the Legend database into a container.
+
+    Args:
+        legend_database_creds: Legend DB creds as returned by
+            `legend_database.get_database_connection_from_mongo_data()`.
+        container: `ops.model.Container` to write the backup into.
+        backup_path: directory within the container to write the backup to.
+        compression: one of `COMPRESSION_GZIP` or `COMPRESSION_ZSTD`.
+        batch_size: number of documents to fetch and write per chunk.
+
+    Views are not backed up as collections, but have their definitions
+    recorded in the manifest so they can be recreated on restore.
+
+    Returns:
+        Dictionary with the backup's path, number of collections, views and
+        documents, compressed size in bytes, duration and throughput.
+
+    Raises:
+        BackupError: if the compression is unsupported.
+    """
+    if compression not in COMPRESSION_FILE_EXTENSIONS:
+        raise BackupError("unsupported compression: %s" % compression)
+
+    start_time = time.monotonic()
+    manifest = {
+        "version": BACKUP_MANIFEST_VERSION,
+        "database": legend_database_creds["database"],
+        "compression": compression,
+        "collections": [],
+        "views": [],
+    }
+    total_bytes = 0
+    with _get_mongo_client(legend_database_creds) as client:
+        database = client[legend_database_creds["database"]]
+        collection_names = database.list_collection_names(filter={"type": "collection"})
+        for collection_name in sorted(collection_names):
+            manifest_entry, byte_count = _backup_collection(
+                database[collection_name], container, backup_path, compression, batch_size
+            )
+            manifest["collections"].append(manifest_entry)
+            total_bytes += byte_count
+        manifest["views"] = _get_views(database)
+
+    container.push(
+        posixpath.join(backup_path, BACKUP_MANIFEST_FILENAME),
+        json_util.dumps(manifest, indent=2, json_options=JSON_OPTIONS),
+        make_dirs=True,
+    )
+
+    res = {
+        "path": backup_path,
+        "collections": len(manifest["collections"]),
+        "views": len(manifest["views"]),
+        "documents": sum(entry["documents"] for entry in manifest["collections"]),
+    }
+    res.update(_get_transfer_stats(total_bytes, start_time))
+    return res
+
+
+def _insert_batch(collection, batch):
+    """Inserts the given documents in a single unordered batch.
+
+    Documents whose `_id` already exists in the collection are skipped.
+
+    Returns a tuple of the number of documents inserted and skipped.
+
+    Raises:
+        BackupError: if any document failed to be inserted for any other reason.
+    """
+    try:
+        return len(collection.insert_many(batch, ordered=False).inserted_ids), 0
+    except errors.BulkWriteError as ex:
+        write_errors = ex.details.get("writeErrors", [])
+        other_errors = [e for e in write_errors if e.get("code") != DUPLICATE_KEY_ERROR_CODE]
+        if other_errors or ex.details.get("writeConcernErrors"):
+            raise BackupError(
+                "failed to insert documents into collection '%s': %s"
+                % (collection.name, other_errors or ex.details["writeConcernErrors"])
+            ) from ex
+        return ex.details.get("nInserted", 0), len(write_errors)
+
+
+def _insert_batches(collection, lines, batch_size):
+    """Inserts the JSON documents from `lines` in unordered batches.
+
+    Returns a tuple of the number of documents inserted and the number of
+    documents skipped as their `_id` was already present.
+    """
+    inserted = 0
+    duplicates = 0
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        batch.append(json_util.loads(line, json_options=JSON_OPTIONS))
+        if len(batch) >= batch_size:
+            batch_inserted, batch_duplicates = _insert_batch(collection, batch)
+            inserted += batch_inserted
+            duplicates += batch_duplicates
+            batch = []
+    if batch:
+        batch_inserted, batch_duplicates = _insert_batch(collection, batch)
+        inserted += batch_inserted
+        duplicates += batch_duplicates
+    return inserted, duplicates
+
+
+def _restore_collection(
+    collection, manifest_entry, container, backup_path, compression, batch_size
+):
+    """Streams a single collection's documents back from the container.
+
+    Indexes are built once all the documents were inserted.
+
+    Returns a tuple of the number of documents inserted, the number of
+    duplicate documents skipped and the number of compressed bytes read.
+    """
+    pulled = container.pull(posixpath.join(backup_path, manifest_entry["file"]), encoding=None)
+    source = _CountingReader(pulled)
+    with pulled, _open_decompressed(source, compression) as decompressed:
+        inserted, duplicates = _insert_batches(collection, decompressed, batch_size)
+    logger.debug(
+        "Restored %d documents (%d duplicates skipped, %d bytes) into collection '%s'",
+        inserted,
+        duplicates,
+        source.bytes_read,
+        collection.name,
+    )
+
+    indexes = [
+        pymongo.IndexModel([tuple(key) for key in index["keys"]], **index["options"])
+        for index in manifest_entry.get("indexes", [])
+    ]
+    if indexes:
+        collection.create_indexes(indexes)
+
+    return inserted, duplicates, source.bytes_read
+
+
+def _load_backup_manifest(container, backup_path):
+    """Returns the manifest of the backup at the given path in the container.
+
+    Raises:
+        BackupError: if the backup manifest is missing or invalid.
+    """
+    manifest_path = posixpath.join(backup_path, BACKUP_MANIFEST_FILENAME)
+    if not container.exists(manifest_path):
+        raise BackupError("no backup manifest found at %s" % manifest_path)
+    try:
+        manifest = json_util.loads(container.pull(manifest_path).read(), json_options=JSON_OPTIONS)
+    except ValueError as ex:
+        raise BackupError("failed to parse backup manifest %s: %s" % (manifest_path, ex))
+    if not isinstance(manifest, dict) or manifest.get("version") != BACKUP_MANIFEST_VERSION:
+        raise BackupError("unsupported backup manifest: %s" % manifest_path)
+    if manifest.get("compression") not in COMPRESSION_FILE_EXTENSIONS:
+        raise BackupError("unsupported backup compression: %s" % manifest.get("compression"))
+    return manifest
+
+
+def restore_database(
+    legend_database_creds, container, backup_path, batch_size=DEFAULT_BATCH_SIZE, drop=False
+):
+    """Streams a backup written by `backup_database()` back into the Legend database.
+
+    Documents are inserted in unordered batches and the collection indexes
+    are only built once all the documents have been inserted. Documents
+    whose `_id` is already present in the database are skipped and counted
+    as duplicates. Views are recreated once all collections were restored.
+
+    Args:
+        legend_database_creds: Legend DB creds as returned by
+            `legend_database.get_database_connection_from_mongo_data()`.
+        container: `ops.model.Container` to read the backup from.
+        backup_path: directory within the container holding the backup.
+        batch_size: number of documents to insert per batch.
+        drop: whether to drop each collection and view before restoring it.
+
+    Returns:
+        Dictionary with the backup's path, number of collections, views
+        created, documents restored and duplicates skipped, compressed size in bytes, duration
+        and throughput.
+
+    Raises:
+        BackupError: if the backup manifest is missing or invalid, or any
+            documents failed to be inserted for reasons other than duplicates.
+    """
+    start_time = time.monotonic()
+    manifest = _load_backup_manifest(container, backup_path)
+
+    total_bytes = 0
+    total_documents = 0
+    total_duplicates = 0
+    with _get_mongo_client(legend_database_creds) as client:
+        database = client[legend_database_creds["database"]]
+        for manifest_entry in manifest["collections"]:
+            collection = database[manifest_entry["name"]]
+            if drop:
+                collection.drop()
+            inserted, duplicates, byte_count = _restore_collection(
+                collection,
+                manifest_entry,
+                container,
+                backup_path,
+                manifest["compression"],
+                batch_size,
+            )
+            total_documents += inserted
+            total_duplicates += duplicates
+            total_bytes += byte_count
+
+        # NOTE: views are created last as they may depend on the collections:
+        views_created = 0
+        for view in manifest.get("views", []):
+            views_created += _restore_view(database, view, drop)
+
+    res = {
+        "path": backup_path,
+        "collections": len(manifest["collections"]),
+        "views": views_created,
+        "documents": total_documents,
+        "duplicates": total_duplicates,
+    }
+    res.update(_get_transfer_stats(total_bytes, start_time))
+    return res
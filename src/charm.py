@@ -4,16 +4,37 @@
 
 """Module defining a Charm providing database management for FINOS Legend."""
 
+import datetime
+import json
 import logging
+import pathlib
+import posixpath
+import re
+import time
 
 from charms.finos_legend_db_k8s.v0 import legend_database
 from charms.mongodb_k8s.v0.mongodb import MongoConsumer
-from ops import charm, framework, main, model
+from ops import charm, framework, main, model, pebble
+
+import backup
 
 logger = logging.getLogger(__name__)
 
 MONGODB_RELATION_NAME = "db"
 LEGEND_DB_RELATION_NAME = "legend-db"
+LEGEND_DB_CONTAINER_NAME = "legend-db"
+LEGEND_DB_BACKUPS_PATH = "/srv/legend-db/backups"
+# NOTE: backup names must not be able to escape the backups storage:
+LEGEND_DB_BACKUP_NAME_REGEX = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+
+EXPORTER_SERVICE_NAME = "legend-db-exporter"
+EXPORTER_SCRIPT_SOURCE_PATH = pathlib.Path(__file__).parent / "exporter.py"
+EXPORTER_DIR_PATH = "/srv/legend-db/exporter"
+EXPORTER_SCRIPT_PATH = posixpath.join(EXPORTER_DIR_PATH, "exporter.py")
+EXPORTER_CONFIG_PATH = posixpath.join(EXPORTER_DIR_PATH, "config.json")
+EXPORTER_SAMPLE_PATH = posixpath.join(EXPORTER_DIR_PATH, "sample.json")
+# NOTE: samples older than this many probe intervals are considered stale:
+EXPORTER_SAMPLE_STALENESS_INTERVALS = 3
 
 
 class LegendDatabaseManagerCharm(charm.CharmBase):
@@ -28,6 +49,13 @@ class LegendDatabaseManagerCharm(charm.CharmBase):
 
         # General hooks:
         self.framework.observe(self.on.install, self._on_install)
+        self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.legend_db_pebble_ready, self._on_legend_db_pebble_ready)
+
+        # Actions:
+        self.framework.observe(self.on.backup_action, self._on_backup_action)
+        self.framework.observe(self.on.restore_action, self._on_restore_action)
 
         # MongoDB consumer setup:
         self._mongodb_consumer = MongoConsumer(self, MONGODB_RELATION_NAME)
@@ -56,25 +84,250 @@ class LegendDatabaseManagerCharm(charm.CharmBase):
             self.unit.status = model.BlockedStatus("requires relating to: mongodb-k8s")
 
     def _set_stored_defaults(self) -> None:
-        self._stored.set_default(log_level="DEBUG")
+        self._stored.set_default(log_level="DEBUG", update_status=None)
 
     def _on_install(self, _: charm.InstallEvent):
         self.unit.status = model.BlockedStatus("requires relating to: mongodb-k8s")
 
     def _on_config_changed(self, _) -> None:
-        # NOTE(aznashwan): this charm does not yet have any config options:
-        pass
+        if not self.model.config["enable-exporter"]:
+            possible_error_status = self._stop_exporter()
+            if possible_error_status:
+                self.unit.status = possible_error_status
+            return
+
+        possible_error_status = self._setup_exporter_from_relation()
+        if possible_error_status:
+            self.unit.status = possible_error_status
+
+    def _on_legend_db_pebble_ready(self, _: charm.PebbleReadyEvent) -> None:
+        possible_error_status = self._setup_exporter_from_relation()
+        if possible_error_status:
+            self.unit.status = possible_error_status
+
+    def _setup_exporter_from_relation(self):
+        """Sets the exporter up with the creds currently provided by MongoDB.
+
+        Does nothing if MongoDB is not related or has not provided creds yet,
+        in which case the exporter is set up on the next MongoDB relation change.
+
+        Returns a `model.BlockedStatus` if it was unable to start the exporter.
+        """
+        if not self.model.config["enable-exporter"]:
+            return None
+        if not self.model.get_relation(MONGODB_RELATION_NAME):
+            return None
+        legend_database_creds = self._get_mongo_db_credentials(request_database=False)
+        if isinstance(legend_database_creds, (model.WaitingStatus, model.BlockedStatus)):
+            return None
+        return self._update_exporter(legend_database_creds)
+
+    def _is_exporter_configured(self):
+        """Returns whether the exporter config is present in the workload."""
+        container = self.unit.get_container(LEGEND_DB_CONTAINER_NAME)
+        try:
+            return container.can_connect() and container.exists(EXPORTER_CONFIG_PATH)
+        except pebble.APIError as ex:
+            logger.warning("Failed to check for the exporter config: %s", ex)
+            return False
+
+    def _get_exporter_layer(self):
+        """Returns the Pebble layer running the database exporter service."""
+        return {
+            "summary": "Legend DB exporter layer",
+            "description": "Pebble layer probing the Legend MongoDB database",
+            "services": {
+                EXPORTER_SERVICE_NAME: {
+                    "override": "replace",
+                    "summary": "Legend DB latency and health exporter",
+                    "command": "python3 %s %s" % (EXPORTER_SCRIPT_PATH, EXPORTER_CONFIG_PATH),
+                    "startup": "enabled",
+                }
+            },
+        }
+
+    def _stop_exporter(self):
+        """Stops the exporter service and removes its config and last sample.
+
+        The config is removed as it contains the DB creds.
+
+        Returns a `model.BlockedStatus` if it was unable to stop the service.
+        """
+        container = self.unit.get_container(LEGEND_DB_CONTAINER_NAME)
+        if not container.can_connect():
+            return None
+        try:
+            if EXPORTER_SERVICE_NAME in container.get_plan().services:
+                container.stop(EXPORTER_SERVICE_NAME)
+            for path in [EXPORTER_CONFIG_PATH, EXPORTER_SAMPLE_PATH]:
+                if container.exists(path):
+                    container.remove_path(path)
+        except (pebble.APIError, pebble.ChangeError, pebble.PathError) as ex:
+            logger.exception("Failed to stop the database exporter")
+            return model.BlockedStatus("failed to stop database exporter: %s" % ex)
+        return None
+
+    def _update_exporter(self, legend_database_creds):
+        """Pushes the exporter and its config to the workload and (re)starts it.
+
+        Does nothing if the exporter is disabled or the workload container is
+        not reachable yet, in which case it is set up once it becomes ready.
+
+        Returns a `model.BlockedStatus` if it was unable to start the exporter.
+        """
+        if not self.model.config["enable-exporter"]:
+            return None
+        container = self.unit.get_container(LEGEND_DB_CONTAINER_NAME)
+        if not container.can_connect():
+            logger.debug("Exporter will be set up once the workload container is ready")
+            return None
+
+        exporter_config = {
+            "uri": legend_database_creds["uri"],
+            "database": legend_database_creds["database"],
+            "port": self.model.config["metrics-port"],
+            "interval": self.model.config["metrics-interval"],
+            "sample-path": EXPORTER_SAMPLE_PATH,
+            "log-level": self._stored.log_level,
+        }
+        # NOTE(aznashwan): the exporter is purely informational, so failing to
+        # start it (e.g. because the workload image lacks python3 or pymongo)
+        # must never fail the hook sharing the creds with the Legend services:
+        try:
+            container.push(
+                EXPORTER_SCRIPT_PATH, EXPORTER_SCRIPT_SOURCE_PATH.read_text(), make_dirs=True
+            )
+            # NOTE: the config contains the DB creds so it is only readable by root:
+            container.push(
+                EXPORTER_CONFIG_PATH,
+                json.dumps(exporter_config),
+                permissions=0o600,
+                make_dirs=True,
+            )
+            container.add_layer(EXPORTER_SERVICE_NAME, self._get_exporter_layer(), combine=True)
+            container.restart(EXPORTER_SERVICE_NAME)
+        except (pebble.APIError, pebble.ChangeError, pebble.PathError) as ex:
+            logger.exception("Failed to start the database exporter")
+            return model.BlockedStatus("failed to start database exporter: %s" % ex)
+        return None
+
+    def _get_exporter_sample(self, container):
+        """Returns the latest database probe sample or a `Waiting/BlockedStatus`."""
+        try:
+            services = container.get_services(EXPORTER_SERVICE_NAME)
+            service = services.get(EXPORTER_SERVICE_NAME)
+            if not service or not service.is_running():
+                return model.BlockedStatus(
+                    "database exporter is not running, the legend-db image "
+                    "must provide python3 and pymongo"
+                )
+            if not container.exists(EXPORTER_SAMPLE_PATH):
+                return model.WaitingStatus("waiting for the first database probe")
+            return json.loads(container.pull(EXPORTER_SAMPLE_PATH).read())
+        except (pebble.APIError, pebble.PathError, pebble.ConnectionError) as ex:
+            logger.warning("Failed to fetch database probe sample: %s", ex)
+        except ValueError as ex:
+            logger.warning("Failed to parse database probe sample: %s", ex)
+        return model.WaitingStatus("waiting for the next database probe")
+
+    def _get_exporter_status(self):
+        """Returns a unit status summarizing the latest database probe."""
+        container = self.unit.get_container(LEGEND_DB_CONTAINER_NAME)
+        if not container.can_connect():
+            return model.WaitingStatus("waiting for the legend-db container")
+        sample = self._get_exporter_sample(container)
+        if isinstance(sample, (model.WaitingStatus, model.BlockedStatus)):
+            return sample
+
+        max_age = self.model.config["metrics-interval"] * EXPORTER_SAMPLE_STALENESS_INTERVALS
+        if time.time() - sample.get("timestamp", 0) > max_age:
+            return model.WaitingStatus("database probe results are stale")
+        if not sample.get("up"):
+            return model.BlockedStatus("database probe failed: %s" % sample.get("error"))
+
+        status_message = "latency: %.1fms" % (sample["latency"] * 1000)
+        if sample.get("replication_lag") is not None:
+            status_message += ", replication lag: %ds" % sample["replication_lag"]
+        if sample.get("connections"):
+            status_message += ", connections: %d" % sample["connections"]["current"]
+        return model.ActiveStatus(status_message)
+
+    def _set_update_status_unit_status(self, status):
+        """Sets the unit status from the update-status hook.
+
+        Statuses set by other hooks are only ever replaced if they are active
+        or empty, so that e.g. errors reported by the relation hooks are preserved.
+        """
+        current_status = self.unit.status
+        last_status = self._stored.update_status
+        set_by_update_status = bool(last_status) and (
+            current_status.name == last_status["name"]
+            and current_status.message == last_status["message"]
+        )
+        replaceable = isinstance(current_status, model.ActiveStatus) or not current_status.message
+        if not replaceable and not set_by_update_status:
+            logger.debug("Not replacing unit status set by another hook: %s", current_status)
+            return
+        self.unit.status = status
+        self._stored.update_status = {"name": status.name, "message": status.message}
+
+    def _get_update_status_unit_status(self):
+        """Returns the unit status as determined by the update-status hook."""
+        if not self.model.get_relation(MONGODB_RELATION_NAME):
+            return model.BlockedStatus("requires relating to: mongodb-k8s")
+
+        legend_database_creds = self._get_mongo_db_credentials(request_database=False)
+        if isinstance(legend_database_creds, (model.WaitingStatus, model.BlockedStatus)):
+            return legend_database_creds
+
+        if not self.model.config["enable-exporter"]:
+            return model.ActiveStatus()
+
+        # Set the exporter back up if the workload container was restarted:
+        if not self._is_exporter_configured():
+            possible_error_status = self._update_exporter(legend_database_creds)
+            if possible_error_status:
+                return possible_error_status
+
+        return self._get_exporter_status()
+
+    def _on_update_status(self, _: charm.UpdateStatusEvent) -> None:
+        self._set_update_status_unit_status(self._get_update_status_unit_status())
 
     def _on_db_relation_joined(self, event: charm.RelationJoinedEvent):
         pass
 
+    def _get_legend_db_endpoints(self, legend_database_creds):
+        """Returns the endpoints to share with the related Legend services.
+
+        All endpoints point to the same MongoDB replica set, so the non-primary
+        ones inherit the primary's URI and only route their reads to
+        secondaries whenever possible.
+        """
+        return {
+            legend_database.LEGEND_DB_PRIMARY_ENDPOINT: {"uri": legend_database_creds["uri"]},
+            legend_database.LEGEND_DB_READ_ENDPOINT: {"options": {"readPreference": "nearest"}},
+            legend_database.LEGEND_DB_ANALYTICS_ENDPOINT: {
+                "options": {"readPreference": "secondaryPreferred"}
+            },
+        }
+
     def _set_legend_db_creds_in_relation(self, legend_database_creds, relation):
         """Attempts to add the given Database creds to the given relation's data.
 
+        The creds are shared in the highest payload version supported by both
+        this charm and the related Legend service.
+
         Returns a `model.BlockedStatus` if it was unable to set the rel data.
         """
-        if not legend_database.set_legend_database_creds_in_relation_data(
-            relation.data[self.app], legend_database_creds
+        payload_version = legend_database.get_negotiated_payload_version(
+            relation.data[relation.app]
+        )
+        if not legend_database.set_legend_database_payload_in_relation_data(
+            relation.data[self.app],
+            legend_database_creds,
+            endpoints=self._get_legend_db_endpoints(legend_database_creds),
+            version=payload_version,
         ):
             return model.BlockedStatus(
                 "failed to set creds in legend db relation: %s" % (relation.id)
@@ -94,8 +347,13 @@ class LegendDatabaseManagerCharm(charm.CharmBase):
                 return possible_blocked_status
         return None
 
-    def _get_mongo_db_credentials(self, rel_id=None):
-        """Returns MongoDB creds or a `Waiting/BlockedStatus` otherwise."""
+    def _get_mongo_db_credentials(self, rel_id=None, request_database=True):
+        """Returns MongoDB creds or a `Waiting/BlockedStatus` otherwise.
+
+        If `request_database` is set and no database was created yet, a new one
+        is requested from MongoDB. This modifies the relation data, so should
+        only be done from the MongoDB relation hooks.
+        """
         # Check whether credentials for a database are available:
         mongo_creds = self._mongodb_consumer.credentials(rel_id)
         if not mongo_creds:
@@ -104,7 +362,8 @@ class LegendDatabaseManagerCharm(charm.CharmBase):
         # Check whether the databases were created:
         databases = self._mongodb_consumer.databases(rel_id)
         if not databases:
-            self._mongodb_consumer.new_database()
+            if request_database:
+                self._mongodb_consumer.new_database()
             return model.WaitingStatus("waiting for mongo database creation")
 
         # Fetch the credentials from the relation data:
@@ -134,29 +393,136 @@ class LegendDatabaseManagerCharm(charm.CharmBase):
             self.unit.status = possible_blocked_status
             return
 
+        # (Re)start the database exporter with the latest creds:
+        possible_error_status = self._update_exporter(legend_database_creds)
+        if possible_error_status:
+            self.unit.status = possible_error_status
+            return
+
         self.unit.status = model.ActiveStatus()
 
-    def _on_legend_db_relation_joined(self, event: charm.RelationJoinedEvent):
-        legend_database_creds = self._get_mongo_db_credentials()
+    def _share_legend_db_creds(self, relation):
+        """Shares the MongoDB creds with the Legend service on the given relation.
+
+        The database itself is only ever requested from the MongoDB relation hooks.
+        """
+        legend_database_creds = self._get_mongo_db_credentials(request_database=False)
         if isinstance(legend_database_creds, (model.WaitingStatus, model.BlockedStatus)):
             logger.warning(
                 "Could not provide Legend MongoDB creds to relation '%s' as none are "
                 "currently available",
-                event.relation.id,
+                relation.id,
             )
             self.unit.status = legend_database_creds
             return
 
         # Add the creds to the relation:
         possible_blocked_status = self._set_legend_db_creds_in_relation(
-            legend_database_creds, event.relation
+            legend_database_creds, relation
         )
         if possible_blocked_status:
             self.unit.status = possible_blocked_status
             return
 
+    def _on_legend_db_relation_joined(self, event: charm.RelationJoinedEvent):
+        self._share_legend_db_creds(event.relation)
+
     def _on_legend_db_relation_changed(self, event: charm.RelationChangedEvent):
-        pass
+        # NOTE(aznashwan): the Legend service may have published the payload
+        # versions it supports, so the creds may need re-sharing in another one:
+        if not self.model.get_relation(MONGODB_RELATION_NAME):
+            return
+        self._share_legend_db_creds(event.relation)
+
+    def _get_action_prerequisites(self, event: charm.ActionEvent):
+        """Returns the Legend DB creds and workload container for backup actions.
+
+        Fails the action and returns `(None, None)` if either is unavailable.
+        """
+        if not self.model.get_relation(MONGODB_RELATION_NAME):
+            event.fail("No MongoDB creds available: requires relating to: mongodb-k8s")
+            return None, None
+
+        legend_database_creds = self._get_mongo_db_credentials(request_database=False)
+        if isinstance(legend_database_creds, (model.WaitingStatus, model.BlockedStatus)):
+            event.fail("No MongoDB creds available: %s" % legend_database_creds.message)
+            return None, None
+
+        container = self.unit.get_container(LEGEND_DB_CONTAINER_NAME)
+        if not container.can_connect():
+            event.fail("Cannot connect to the '%s' container" % LEGEND_DB_CONTAINER_NAME)
+            return None, None
+
+        return legend_database_creds, container
+
+    def _get_backup_path(self, event: charm.ActionEvent, name):
+        """Returns the path of the named backup within the backups storage.
+
+        Fails the action and returns None if the name is invalid.
+        """
+        if not LEGEND_DB_BACKUP_NAME_REGEX.match(name) or ".." in name:
+            event.fail(
+                "Invalid backup name '%s': must only contain letters, digits, "
+                "'.', '_' and '-', and not contain '..'" % name
+            )
+            return None
+        return posixpath.join(LEGEND_DB_BACKUPS_PATH, name)
+
+    def _on_backup_action(self, event: charm.ActionEvent):
+        legend_database_creds, container = self._get_action_prerequisites(event)
+        if not legend_database_creds:
+            return
+
+        name = event.params.get("name") or datetime.datetime.utcnow().strftime(
+            "legend-db-%Y%m%dT%H%M%SZ"
+        )
+        backup_path = self._get_backup_path(event, name)
+        if not backup_path:
+            return
+        if container.exists(backup_path):
+            event.fail("Backup '%s' already exists" % name)
+            return
+
+        try:
+            res = backup.backup_database(
+                legend_database_creds,
+                container,
+                backup_path,
+                compression=event.params["compression"],
+                batch_size=event.params["batch-size"],
+            )
+        except Exception as ex:
+            logger.exception("Failed to back up the Legend database to %s", backup_path)
+            event.fail("Failed to back up the Legend database: %s" % ex)
+            return
+
+        res["name"] = name
+        event.set_results(res)
+
+    def _on_restore_action(self, event: charm.ActionEvent):
+        legend_database_creds, container = self._get_action_prerequisites(event)
+        if not legend_database_creds:
+            return
+
+        backup_path = self._get_backup_path(event, event.params["name"])
+        if not backup_path:
+            return
+
+        try:
+            res = backup.restore_database(
+                legend_database_creds,
+                container,
+                backup_path,
+                batch_size=event.params["batch-size"],
+                drop=event.params["drop"],
+            )
+        except Exception as ex:
+            logger.exception("Failed to restore the Legend database from %s", backup_path)
+            event.fail("Failed to restore the Legend database: %s" % ex)
+            return
+
+        res["name"] = event.params["name"]
+        event.set_results(res)
 
 
 if __name__ == "__main__":
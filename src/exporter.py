@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# Copyright 2021 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Long-running probe exporting Legend database performance metrics.
+
+This script is pushed by the charm into the legend-db workload container and
+run there as a Pebble service. At a fixed interval it measures the round-trip
+latency, replication lag and connection counts of the managed MongoDB, serves
+them as Prometheus metrics over HTTP and writes the latest sample as JSON to
+a file the charm reads back on update-status.
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+import pymongo
+from pymongo import errors
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "legend_db"
+SERVER_SELECTION_TIMEOUT_MS = 5000
+
+
+def _get_replication_lag(client):
+    """Returns the maximum replication lag of the secondaries in seconds.
+
+    Returns None if the server is not part of a replica set or the user is
+    not allowed to query the replica set status.
+    """
+    try:
+        status = client.admin.command("replSetGetStatus")
+    except errors.OperationFailure as ex:
+        logger.debug("Could not fetch replica set status: %s", ex)
+        return None
+
+    members = status.get("members", [])
+    primary_optimes = [m["optimeDate"] for m in members if m.get("stateStr") == "PRIMARY"]
+    if not primary_optimes:
+        return None
+    secondary_lags = [
+        (primary_optimes[0] - m["optimeDate"]).total_seconds()
+        for m in members
+        if m.get("stateStr") == "SECONDARY" and m.get("optimeDate")
+    ]
+    return max(secondary_lags, default=0.0)
+
+
+def _get_connections(client):
+    """Returns the current and available connection counts of the server.
+
+    Returns None if the user is not allowed to query the server status.
+    """
+    try:
+        connections = client.admin.command("serverStatus").get("connections", {})
+    except errors.OperationFailure as ex:
+        logger.debug("Could not fetch server status: %s", ex)
+        return None
+    return {
+        "current": connections.get("current", 0),
+        "available": connections.get("available", 0),
+    }
+
+
+def probe(client, database):
+    """Probes the given database and returns a sample of its metrics.
+
+    Returns:
+        Dictionary with the following structure:
+        {
+            "timestamp": <UNIX time of the probe>,
+            "up": <whether the database answered the probe>,
+            "error": "<error message if the probe failed>",
+            "latency": <ping round-trip time in seconds>,
+            "replication_lag": <maximum secondary lag in seconds or None>,
+            "connections": {"current": <count>, "available": <count>} or None
+        }
+    """
+    sample = {
+        "timestamp": time.time(),
+        "up": False,
+        "error": "",
+        "latency": None,
+        "replication_lag": None,
+        "connections": None,
+    }
+    try:
+        start_time = time.monotonic()
+        client[database].command("ping")
+        sample["latency"] = time.monotonic() - start_time
+        sample["replication_lag"] = _get_replication_lag(client)
+        sample["connections"] = _get_connections(client)
+        sample["up"] = True
+    except errors.PyMongoError as ex:
+        logger.warning("Failed to probe database '%s': %s", database, ex)
+        sample["error"] = str(ex)
+    return sample
+
+
+def format_metrics(sample):
+    """Returns the given sample in the Prometheus text exposition format."""
+    lines = []
+
+    def _add_metric(name, metric_type, help_text, value, labels=None):
+        name = "%s_%s" % (METRICS_PREFIX, name)
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+        for label_set, label_value in (labels or {None: value}).items():
+            label_str = '{state="%s"}' % label_set if label_set else ""
+            lines.append("%s%s %s" % (name, label_str, label_value))
+
+    _add_metric("up", "gauge", "Whether the database answered the last probe.", int(sample["up"]))
+    _add_metric(
+        "probe_timestamp_seconds", "gauge", "UNIX time of the last probe.", sample["timestamp"]
+    )
+    if sample["latency"] is not None:
+        _add_metric(
+            "ping_latency_seconds", "gauge", "Round-trip time of a ping.", sample["latency"]
+        )
+    if sample["replication_lag"] is not None:
+        _add_metric(
+            "replication_lag_seconds",
+            "gauge",
+            "Maximum replication lag of the secondaries.",
+            sample["replication_lag"],
+        )
+    if sample["connections"] is not None:
+        _add_metric(
+            "connections",
+            "gauge",
+            "Number of connections to the database server.",
+            None,
+            labels=sample["connections"],
+        )
+    return "\n".join(lines) + "\n"
+
+
+def write_sample(path, sample):
+    """Atomically writes the given sample as JSON to the given path."""
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as fout:
+        json.dump(sample, fout)
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the latest metrics of the exporter on `/metrics`."""
+
+    metrics = format_metrics(
+        {
+            "timestamp": 0,
+            "up": False,
+            "latency": None,
+            "replication_lag": None,
+            "connections": None,
+        }
+    )
+
+    def do_GET(self):  # noqa: N802
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.metrics.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    """Runs the exporter using the config file passed on the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("config", help="Path to the JSON config file of the exporter.")
+    args = parser.parse_args()
+    with open(args.config) as fin:
+        config = json.load(fin)
+
+    logging.basicConfig(level=config.get("log-level", "INFO"))
+    client = pymongo.MongoClient(
+        config["uri"], serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS
+    )
+    server = http.server.ThreadingHTTPServer(("", config["port"]), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving Legend DB metrics on port %d", config["port"])
+
+    while True:
+        sample = probe(client, config["database"])
+        _MetricsHandler.metrics = format_metrics(sample)
+        write_sample(config["sample-path"], sample)
+        time.sleep(config["interval"])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,19 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import datetime
+import json
+import time
 import unittest
 from unittest import mock
 
-from ops import model
+import bson
+from charms.finos_legend_db_k8s.v0 import legend_database
+from ops import model, pebble
 from ops import testing as ops_testing
+from pymongo import errors as mongo_errors
 
+import backup
 import charm
 
 
@@ -73,13 +80,18 @@ class TestCharm(unittest.TestCase):
         "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
     )
     @mock.patch(
-        "charms.finos_legend_db_k8s.v0.legend_database.set_legend_database_creds_in_relation_data"
+        "charms.finos_legend_db_k8s.v0.legend_database.set_legend_database_payload_in_relation_data"
     )
     def test_mongo_relation_established(
         self, _set_rel_cred_mock, _get_rel_creds_mock, _mongo_consumer_cls_mock
     ):
         testing_database = "testdb"
-        mongodb_test_creds = {"testing": "credentials"}
+        mongodb_test_creds = {
+            "uri": "mongodb://testuri",
+            "username": "testuser",
+            "password": "testpass",
+            "database": testing_database,
+        }
         mongo_consumer_mock = self._mock_mongo_consumer_cls(mongodb_test_creds, [testing_database])
         _mongo_consumer_cls_mock.return_value = mongo_consumer_mock
 
@@ -103,6 +115,452 @@ class TestCharm(unittest.TestCase):
         _get_rel_creds_mock.assert_has_calls(
             [mock.call(mongodb_test_creds, [testing_database])] * 2
         )
+        expected_endpoints = {
+            "primary": {"uri": "mongodb://testuri"},
+            "read": {"options": {"readPreference": "nearest"}},
+            "analytics": {"options": {"readPreference": "secondaryPreferred"}},
+        }
+        # NOTE: the relator does not publish any payload versions so gets v0:
         _set_rel_cred_mock.assert_has_calls(
-            [mock.call({}, mongodb_test_creds)] * 2, any_order=True
+            [mock.call({}, mongodb_test_creds, endpoints=expected_endpoints, version=0)] * 2,
+            any_order=True,
+        )
+
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_legend_db_payload_version_negotiation(self, _get_rel_creds_mock):
+        mongodb_test_creds = {
+            "uri": "mongodb://testuri",
+            "username": "testuser",
+            "password": "testpass",
+            "database": "testdb",
+        }
+        _get_rel_creds_mock.return_value = mongodb_test_creds
+        self._begin_with_mongo_relation()
+
+        # Relator without any published versions gets the v0 creds:
+        rel_id = self.harness.add_relation(charm.LEGEND_DB_RELATION_NAME, "some-relator")
+        self.harness.add_relation_unit(rel_id, "some-relator/0")
+        rel_data = self.harness.get_relation_data(rel_id, self.harness.charm.app.name)
+        self.assertEqual(
+            json.loads(rel_data[legend_database.LEGEND_DB_RELATION_DATA_KEY]), mongodb_test_creds
+        )
+        self.assertNotIn(legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY, rel_data)
+
+        # Relator publishing v1 support gets only the v1 payload:
+        self.harness.update_relation_data(
+            rel_id, "some-relator", {legend_database.LEGEND_DB_RELATION_VERSIONS_KEY: "[0, 1]"}
+        )
+        rel_data = self.harness.get_relation_data(rel_id, self.harness.charm.app.name)
+        self.assertNotIn(legend_database.LEGEND_DB_RELATION_DATA_KEY, rel_data)
+        self.assertEqual(rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY], "1")
+        payload = json.loads(rel_data[legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY])
+        self.assertEqual(payload["version"], 1)
+        # NOTE: the non-primary endpoints inherit the primary's URI:
+        self.assertEqual(payload["endpoints"]["read"], {"options": {"readPreference": "nearest"}})
+
+    def _mock_mongo_client(self, collections, views=None):
+        """Returns a mock `pymongo.MongoClient` serving the given collections.
+
+        `collections` maps collection names to a tuple of the list of documents
+        and the index information the collection should return, while `views`
+        is a list of view infos as returned by `Database.list_collections()`.
+        """
+        collection_mocks = {}
+        for name, (documents, index_information) in collections.items():
+            collection = mock.MagicMock()
+            collection.name = name
+            collection.find.return_value = documents
+            collection.index_information.return_value = index_information
+            collection.insert_many.side_effect = lambda docs, ordered: mock.MagicMock(
+                inserted_ids=[doc["_id"] for doc in docs]
+            )
+            collection_mocks[name] = collection
+
+        database = mock.MagicMock()
+        database.list_collection_names.return_value = list(collections)
+        database.list_collections.return_value = views or []
+        database.__getitem__.side_effect = collection_mocks.__getitem__
+        client = mock.MagicMock()
+        client.__enter__.return_value.__getitem__.return_value = database
+        return client, collection_mocks
+
+    def _begin_with_mongo_relation(self):
+        """Begins the charm with a related MongoDB and a reachable workload container.
+
+        Returns the ID of the MongoDB relation.
+        """
+        mongo_consumer_mock = self._mock_mongo_consumer_cls({"testing": "creds"}, ["testdb"])
+        rel_id = self._add_mongo_relation({})
+        self.harness.set_leader()
+        self.harness.begin()
+        self.harness.charm._mongodb_consumer = mongo_consumer_mock
+        self.harness.set_can_connect(charm.LEGEND_DB_CONTAINER_NAME, True)
+        return rel_id
+
+    @mock.patch("backup.pymongo.MongoClient")
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_backup_and_restore_actions(self, _get_rel_creds_mock, _mongo_client_cls_mock):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        documents = [{"_id": i, "value": "document %d" % i} for i in range(5)]
+        index_information = {
+            "_id_": {"v": 2, "key": [("_id", 1)]},
+            "value_1": {"v": 2, "key": [("value", 1)], "unique": True},
+        }
+        self._begin_with_mongo_relation()
+
+        for compression in ["gzip", "zstd"]:
+            client, collections = self._mock_mongo_client(
+                {"projects": (documents, index_information)}
+            )
+            _mongo_client_cls_mock.return_value = client
+            output = self.harness.run_action(
+                "backup",
+                {"name": compression, "compression": compression, "batch-size": 2},
+            )
+            self.assertEqual(output.results["collections"], 1)
+            self.assertEqual(output.results["documents"], len(documents))
+            self.assertGreater(output.results["bytes"], 0)
+            self.assertIn("bytes-per-second", output.results)
+            collections["projects"].find.assert_called_once_with(batch_size=2)
+
+            output = self.harness.run_action(
+                "restore", {"name": compression, "batch-size": 2, "drop": True}
+            )
+            self.assertEqual(output.results["documents"], len(documents))
+            restored = collections["projects"]
+            restored.drop.assert_called_once_with()
+            self.assertEqual(
+                restored.insert_many.call_args_list,
+                [
+                    mock.call(documents[0:2], ordered=False),
+                    mock.call(documents[2:4], ordered=False),
+                    mock.call(documents[4:], ordered=False),
+                ],
+            )
+            restored.create_indexes.assert_called_once()
+            (index_models,), _ = restored.create_indexes.call_args
+            self.assertEqual(
+                [index.document for index in index_models],
+                [{"key": {"value": 1}, "name": "value_1", "unique": True}],
+            )
+
+    def test_backup_action_no_creds(self):
+        self._begin_with_mongo_relation()
+        self.harness.charm._mongodb_consumer = self._mock_mongo_consumer_cls({}, [])
+        with self.assertRaises(ops_testing.ActionFailed) as cm:
+            self.harness.run_action("backup")
+        self.assertIn("waiting for mongo database credentials", cm.exception.message)
+
+    def test_backup_action_no_database(self):
+        self._begin_with_mongo_relation()
+        mongo_consumer_mock = self._mock_mongo_consumer_cls({"testing": "creds"}, [])
+        self.harness.charm._mongodb_consumer = mongo_consumer_mock
+        for action in ["backup", "restore"]:
+            with self.assertRaises(ops_testing.ActionFailed) as cm:
+                self.harness.run_action(action, {"name": "test"})
+            self.assertIn("waiting for mongo database creation", cm.exception.message)
+        # Actions must never request a database:
+        mongo_consumer_mock.new_database.assert_not_called()
+
+    @mock.patch("backup.pymongo.MongoClient")
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_backup_and_restore_bson_types(self, _get_rel_creds_mock, _mongo_client_cls_mock):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        document = {
+            "_id": bson.ObjectId(),
+            "int64": bson.Int64(5),
+            "decimal": bson.Decimal128("1.10"),
+            "date": datetime.datetime(1960, 1, 1, 12, 30),
+        }
+        client, collections = self._mock_mongo_client({"projects": ([document], {})})
+        _mongo_client_cls_mock.return_value = client
+        self._begin_with_mongo_relation()
+
+        self.harness.run_action("backup", {"name": "types"})
+        self.harness.run_action("restore", {"name": "types"})
+
+        (restored_documents,), _ = collections["projects"].insert_many.call_args
+        self.assertEqual(restored_documents, [document])
+        restored = restored_documents[0]
+        self.assertIsInstance(restored["_id"], bson.ObjectId)
+        self.assertIsInstance(restored["int64"], bson.Int64)
+        self.assertIsInstance(restored["decimal"], bson.Decimal128)
+        self.assertEqual(restored["decimal"], bson.Decimal128("1.10"))
+        self.assertIsInstance(restored["date"], datetime.datetime)
+
+    @mock.patch("backup.pymongo.MongoClient")
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_backup_and_restore_views(self, _get_rel_creds_mock, _mongo_client_cls_mock):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        view_options = {"viewOn": "projects", "pipeline": [{"$match": {"active": True}}]}
+        client, collections = self._mock_mongo_client(
+            {"projects": ([{"_id": 1, "active": True}], {})},
+            views=[{"name": "active-projects", "type": "view", "options": view_options}],
         )
+        database = client.__enter__.return_value.__getitem__.return_value
+        _mongo_client_cls_mock.return_value = client
+        self._begin_with_mongo_relation()
+
+        output = self.harness.run_action("backup", {"name": "views"})
+        self.assertEqual(output.results["collections"], 1)
+        self.assertEqual(output.results["views"], 1)
+        database.list_collection_names.assert_called_once_with(filter={"type": "collection"})
+        database.list_collections.assert_called_once_with(filter={"type": "view"})
+
+        output = self.harness.run_action("restore", {"name": "views", "drop": True})
+        self.assertEqual(output.results["views"], 1)
+        database.drop_collection.assert_called_once_with("active-projects")
+        database.create_collection.assert_called_once_with("active-projects", **view_options)
+
+        # Existing views are left untouched without 'drop':
+        database.create_collection.side_effect = mongo_errors.CollectionInvalid("exists")
+        output = self.harness.run_action("restore", {"name": "views"})
+        self.assertEqual(output.results["views"], 0)
+        database.drop_collection.assert_called_once_with("active-projects")
+
+    def test_backup_action_no_mongo_relation(self):
+        self.harness.set_leader()
+        self.harness.begin()
+        self.harness.set_can_connect(charm.LEGEND_DB_CONTAINER_NAME, True)
+        for action in ["backup", "restore"]:
+            with self.assertRaises(ops_testing.ActionFailed) as cm:
+                self.harness.run_action(action, {"name": "test"})
+            self.assertIn("requires relating to: mongodb-k8s", cm.exception.message)
+
+    @mock.patch("backup.pymongo.MongoClient")
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_backup_actions_invalid_name(self, _get_rel_creds_mock, _mongo_client_cls_mock):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        self._begin_with_mongo_relation()
+        for action in ["backup", "restore"]:
+            for name in ["/etc", "../../x", "a/b", "..", ".hidden"]:
+                with self.assertRaises(ops_testing.ActionFailed) as cm:
+                    self.harness.run_action(action, {"name": name})
+                self.assertIn("Invalid backup name", cm.exception.message)
+        _mongo_client_cls_mock.assert_not_called()
+
+    @mock.patch("backup.pymongo.MongoClient")
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_restore_action_duplicates(self, _get_rel_creds_mock, _mongo_client_cls_mock):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        documents = [{"_id": i} for i in range(3)]
+        client, collections = self._mock_mongo_client({"projects": (documents, {})})
+        _mongo_client_cls_mock.return_value = client
+        self._begin_with_mongo_relation()
+        self.harness.run_action("backup", {"name": "dups"})
+
+        # Two of the three documents are already present in the database:
+        collections["projects"].insert_many.side_effect = mongo_errors.BulkWriteError(
+            {
+                "nInserted": 1,
+                "writeErrors": [
+                    {"index": 0, "code": backup.DUPLICATE_KEY_ERROR_CODE},
+                    {"index": 1, "code": backup.DUPLICATE_KEY_ERROR_CODE},
+                ],
+            }
+        )
+        output = self.harness.run_action("restore", {"name": "dups"})
+        self.assertEqual(output.results["documents"], 1)
+        self.assertEqual(output.results["duplicates"], 2)
+        collections["projects"].drop.assert_not_called()
+
+        # Any other write error fails the action:
+        collections["projects"].insert_many.side_effect = mongo_errors.BulkWriteError(
+            {"nInserted": 0, "writeErrors": [{"index": 0, "code": 121}]}
+        )
+        with self.assertRaises(ops_testing.ActionFailed) as cm:
+            self.harness.run_action("restore", {"name": "dups"})
+        self.assertIn("failed to insert documents", cm.exception.message)
+
+    def test_restore_action_missing_backup(self):
+        self._begin_with_mongo_relation()
+        with mock.patch(
+            "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+        ) as _get_rel_creds_mock:
+            _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+            with self.assertRaises(ops_testing.ActionFailed) as cm:
+                self.harness.run_action("restore", {"name": "missing"})
+        self.assertIn("no backup manifest found", cm.exception.message)
+
+    def _push_exporter_sample(self, **overrides):
+        sample = {
+            "timestamp": time.time(),
+            "up": True,
+            "error": "",
+            "latency": 0.0012,
+            "replication_lag": 2.0,
+            "connections": {"current": 12, "available": 100},
+        }
+        sample.update(overrides)
+        container = self.harness.charm.unit.get_container(charm.LEGEND_DB_CONTAINER_NAME)
+        container.push(charm.EXPORTER_SAMPLE_PATH, json.dumps(sample), make_dirs=True)
+
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_update_status_exporter(self, _get_rel_creds_mock):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        self._begin_with_mongo_relation()
+        container = self.harness.charm.unit.get_container(charm.LEGEND_DB_CONTAINER_NAME)
+
+        # Exporter is disabled by default:
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.unit.status, model.ActiveStatus())
+        self.assertNotIn(charm.EXPORTER_SERVICE_NAME, container.get_plan().services)
+
+        # Exporter gets set up once enabled and awaits its first probe:
+        self.harness.update_config({"enable-exporter": True})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            model.WaitingStatus("waiting for the first database probe"),
+        )
+        self.assertIn(charm.EXPORTER_SERVICE_NAME, container.get_plan().services)
+        self.assertTrue(container.get_service(charm.EXPORTER_SERVICE_NAME).is_running())
+        exporter_config = json.loads(container.pull(charm.EXPORTER_CONFIG_PATH).read())
+        self.assertEqual(exporter_config["uri"], "mongodb://test")
+        self.assertEqual(exporter_config["port"], 9217)
+
+        # Healthy probe:
+        self._push_exporter_sample()
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            model.ActiveStatus("latency: 1.2ms, replication lag: 2s, connections: 12"),
+        )
+
+        # Failed probe:
+        self._push_exporter_sample(up=False, error="timed out")
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status, model.BlockedStatus("database probe failed: timed out")
+        )
+
+        # Stale probe:
+        self._push_exporter_sample(timestamp=time.time() - 3600)
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            model.WaitingStatus("database probe results are stale"),
+        )
+
+        # Config changes are propagated to the exporter:
+        self.harness.update_config({"metrics-port": 9999})
+        exporter_config = json.loads(container.pull(charm.EXPORTER_CONFIG_PATH).read())
+        self.assertEqual(exporter_config["port"], 9999)
+        self.assertEqual(exporter_config["uri"], "mongodb://test")
+
+        # Crashed exporter:
+        container.stop(charm.EXPORTER_SERVICE_NAME)
+        self.harness.charm.on.update_status.emit()
+        self.assertIsInstance(self.harness.charm.unit.status, model.BlockedStatus)
+        self.assertIn("database exporter is not running", self.harness.charm.unit.status.message)
+        container.start(charm.EXPORTER_SERVICE_NAME)
+
+        # Disabling the exporter stops it and removes its creds:
+        self.harness.update_config({"enable-exporter": False})
+        self.assertFalse(container.get_service(charm.EXPORTER_SERVICE_NAME).is_running())
+        self.assertFalse(container.exists(charm.EXPORTER_CONFIG_PATH))
+        self.assertFalse(container.exists(charm.EXPORTER_SAMPLE_PATH))
+
+        # Re-enabling it uses the current creds from the relation:
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://new", "database": "testdb"}
+        self.harness.update_config({"enable-exporter": True})
+        exporter_config = json.loads(container.pull(charm.EXPORTER_CONFIG_PATH).read())
+        self.assertEqual(exporter_config["uri"], "mongodb://new")
+        self.assertTrue(container.get_service(charm.EXPORTER_SERVICE_NAME).is_running())
+
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_exporter_pebble_ready(self, _get_rel_creds_mock):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        self._begin_with_mongo_relation()
+        self.harness.set_can_connect(charm.LEGEND_DB_CONTAINER_NAME, False)
+        self.harness.update_config({"enable-exporter": True})
+        container = self.harness.charm.unit.get_container(charm.LEGEND_DB_CONTAINER_NAME)
+
+        self.harness.container_pebble_ready(charm.LEGEND_DB_CONTAINER_NAME)
+        self.assertTrue(container.get_service(charm.EXPORTER_SERVICE_NAME).is_running())
+        self.assertTrue(container.exists(charm.EXPORTER_CONFIG_PATH))
+
+    def test_update_status_does_not_request_database(self):
+        self._begin_with_mongo_relation()
+        mongo_consumer_mock = self._mock_mongo_consumer_cls({"testing": "creds"}, [])
+        self.harness.charm._mongodb_consumer = mongo_consumer_mock
+        self.harness.update_config({"enable-exporter": True})
+        for _ in range(3):
+            self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            model.WaitingStatus("waiting for mongo database creation"),
+        )
+        mongo_consumer_mock.new_database.assert_not_called()
+
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_update_status_preserves_other_statuses(self, _get_rel_creds_mock):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        self._begin_with_mongo_relation()
+        blocked_status = model.BlockedStatus("failed to set creds in legend db relation: 1")
+        self.harness.charm.unit.status = blocked_status
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.unit.status, blocked_status)
+
+        # Statuses set by update-status itself do get updated:
+        self.harness.charm.unit.status = model.ActiveStatus()
+        self.harness.update_config({"enable-exporter": True})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            model.WaitingStatus("waiting for the first database probe"),
+        )
+        self._push_exporter_sample()
+        self.harness.charm.on.update_status.emit()
+        self.assertIsInstance(self.harness.charm.unit.status, model.ActiveStatus)
+
+    def test_update_status_no_mongo_relation(self):
+        self.harness.set_leader()
+        self.harness.begin()
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            model.BlockedStatus("requires relating to: mongodb-k8s"),
+        )
+
+    @mock.patch("ops.model.Container.restart")
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.set_legend_database_payload_in_relation_data"
+    )
+    @mock.patch(
+        "charms.finos_legend_db_k8s.v0.legend_database.get_database_connection_from_mongo_data"
+    )
+    def test_exporter_start_failure(
+        self, _get_rel_creds_mock, _set_rel_cred_mock, _container_restart_mock
+    ):
+        _get_rel_creds_mock.return_value = {"uri": "mongodb://test", "database": "testdb"}
+        _container_restart_mock.side_effect = pebble.ChangeError(
+            "cannot start service: exited quickly", mock.MagicMock()
+        )
+        self._add_consumer_relation("some-relator", {})
+        mongo_rel_id = self._begin_with_mongo_relation()
+        self.harness.update_config({"enable-exporter": True})
+
+        # The creds still get shared with the Legend services:
+        self.harness.update_relation_data(mongo_rel_id, "mongodb-k8s/0", {"any": "thing"})
+        _set_rel_cred_mock.assert_called()
+        self.assertIsInstance(self.harness.charm.unit.status, model.BlockedStatus)
+        self.assertIn("failed to start database exporter", self.harness.charm.unit.status.message)
@@ -0,0 +1,79 @@
+# Copyright 2021 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import datetime
+import unittest
+from unittest import mock
+
+from pymongo import errors
+
+import exporter
+
+
+class TestExporter(unittest.TestCase):
+    def _mock_client(self, admin_command_side_effect):
+        client = mock.MagicMock()
+        client.admin.command.side_effect = admin_command_side_effect
+        return client
+
+    def test_probe(self):
+        now = datetime.datetime(2021, 10, 1, 12, 0, 0)
+
+        def _admin_command(command):
+            if command == "replSetGetStatus":
+                return {
+                    "members": [
+                        {"stateStr": "PRIMARY", "optimeDate": now},
+                        {"stateStr": "SECONDARY", "optimeDate": now - datetime.timedelta(0, 3)},
+                        {"stateStr": "SECONDARY", "optimeDate": now - datetime.timedelta(0, 1)},
+                    ]
+                }
+            return {"connections": {"current": 7, "available": 93}}
+
+        client = self._mock_client(_admin_command)
+        sample = exporter.probe(client, "testdb")
+
+        client.__getitem__.assert_called_once_with("testdb")
+        client.__getitem__.return_value.command.assert_called_once_with("ping")
+        self.assertTrue(sample["up"])
+        self.assertGreaterEqual(sample["latency"], 0)
+        self.assertEqual(sample["replication_lag"], 3.0)
+        self.assertEqual(sample["connections"], {"current": 7, "available": 93})
+
+    def test_probe_unauthorized(self):
+        client = self._mock_client(errors.OperationFailure("not authorized"))
+        sample = exporter.probe(client, "testdb")
+
+        self.assertTrue(sample["up"])
+        self.assertIsNone(sample["replication_lag"])
+        self.assertIsNone(sample["connections"])
+
+    def test_probe_down(self):
+        client = mock.MagicMock()
+        client.__getitem__.return_value.command.side_effect = errors.ServerSelectionTimeoutError(
+            "timed out"
+        )
+        sample = exporter.probe(client, "testdb")
+
+        self.assertFalse(sample["up"])
+        self.assertEqual(sample["error"], "timed out")
+        self.assertIsNone(sample["latency"])
+
+    def test_format_metrics(self):
+        metrics = exporter.format_metrics(
+            {
+                "timestamp": 1633089600.0,
+                "up": True,
+                "latency": 0.0012,
+                "replication_lag": None,
+                "connections": {"current": 7, "available": 93},
+            }
+        )
+
+        self.assertIn("legend_db_up 1\n", metrics)
+        self.assertIn("legend_db_probe_timestamp_seconds 1633089600.0\n", metrics)
+        self.assertIn("legend_db_ping_latency_seconds 0.0012\n", metrics)
+        self.assertNotIn("legend_db_replication_lag_seconds", metrics)
+        self.assertIn('legend_db_connections{state="current"} 7\n', metrics)
+        self.assertIn('legend_db_connections{state="available"} 93\n', metrics)
+        self.assertIn("# TYPE legend_db_connections gauge\n", metrics)
@@ -162,3 +162,308 @@ class TestLegendDBConsumer(unittest.TestCase):
 
         res = self.harness.charm.legend_db_consumer.get_legend_database_creds(rel_id)
         self.assertEqual(res, creds)
+
+    def test_get_negotiated_payload_version(self):
+        versions_key = legend_database.LEGEND_DB_RELATION_VERSIONS_KEY
+        # Consumers which do not publish any versions only support v0:
+        self.assertEqual(legend_database.get_negotiated_payload_version({}), 0)
+        # Invalid versions:
+        self.assertEqual(
+            legend_database.get_negotiated_payload_version({versions_key: "not json"}), 0
+        )
+        self.assertEqual(legend_database.get_negotiated_payload_version({versions_key: "13"}), 0)
+        # Highest common version:
+        self.assertEqual(
+            legend_database.get_negotiated_payload_version({versions_key: "[0, 1]"}), 1
+        )
+        self.assertEqual(
+            legend_database.get_negotiated_payload_version({versions_key: "[0, 1, 7]"}), 1
+        )
+        self.assertEqual(legend_database.get_negotiated_payload_version({versions_key: "[0]"}), 0)
+        self.assertEqual(legend_database.get_negotiated_payload_version({versions_key: "[7]"}), 0)
+        # Versions which are not ints are ignored:
+        for versions in ["[[1]]", "[{}]", "[true]", '["1"]', "[1.0]"]:
+            self.assertEqual(
+                legend_database.get_negotiated_payload_version({versions_key: versions}), 0
+            )
+        self.assertEqual(
+            legend_database.get_negotiated_payload_version({versions_key: "[[0], {}, 1]"}), 1
+        )
+
+    def test_set_legend_database_payload_in_relation_data(self):
+        creds = {
+            "uri": "testuri",
+            "username": "testuser",
+            "password": "testpass",
+            "database": "testdb",
+        }
+
+        # Invalid creds, endpoints or version leave the relation data untouched:
+        rel_data = {}
+        self.assertFalse(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, {"totally": "invalid"}
+            )
+        )
+        self.assertFalse(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, endpoints={"read": {"uri": 13}}
+            )
+        )
+        self.assertFalse(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, endpoints={"primary": {"options": {}}}
+            )
+        )
+        self.assertFalse(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, endpoints={"read": "readuri"}, version=0
+            )
+        )
+        self.assertFalse(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, version=7
+            )
+        )
+        self.assertEqual(rel_data, {})
+
+        # Version 0 only sets the flat creds:
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, version=0
+            )
+        )
+        self.assertEqual(
+            rel_data, {legend_database.LEGEND_DB_RELATION_DATA_KEY: json.dumps(creds)}
+        )
+
+        # Version 1 only sets the payload and its revision:
+        endpoints = {"read": {"uri": "readuri", "options": {"readPreference": "nearest"}}}
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, endpoints=endpoints, options={"retryWrites": True}
+            )
+        )
+        self.assertEqual(
+            set(rel_data),
+            {
+                legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY,
+                legend_database.LEGEND_DB_RELATION_REVISION_KEY,
+            },
+        )
+        self.assertEqual(rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY], "1")
+        self.assertEqual(
+            json.loads(rel_data[legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY]),
+            {
+                "version": legend_database.LEGEND_DB_PAYLOAD_VERSION,
+                "revision": 1,
+                "username": "testuser",
+                "password": "testpass",
+                "database": "testdb",
+                "endpoints": {
+                    "primary": {"uri": "testuri"},
+                    "read": {"uri": "readuri", "options": {"readPreference": "nearest"}},
+                },
+                "options": {"retryWrites": True},
+            },
+        )
+
+        # Unchanged payload keeps its revision:
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, endpoints=endpoints, options={"retryWrites": True}
+            )
+        )
+        self.assertEqual(rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY], "1")
+
+        # Changed payload bumps its revision:
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(rel_data, creds)
+        )
+        self.assertEqual(rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY], "2")
+        payload = json.loads(rel_data[legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY])
+        self.assertEqual(payload["revision"], 2)
+        self.assertEqual(payload["endpoints"], {"primary": {"uri": "testuri"}})
+
+        # Unreadable payloads still get a higher revision than the last one:
+        rel_data[legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY] = "not json"
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(rel_data, creds)
+        )
+        self.assertEqual(rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY], "3")
+        payload = json.loads(rel_data[legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY])
+        self.assertEqual(payload["revision"], 3)
+
+    def test_set_legend_database_payload_inherited_uris(self):
+        creds = {
+            "uri": "testuri",
+            "username": "testuser",
+            "password": "testpass",
+            "database": "testdb",
+        }
+        rel_data = {}
+        endpoints = {
+            "read": {"uri": "testuri", "options": {"readPreference": "nearest"}},
+            "analytics": {"options": {"readPreference": "secondaryPreferred"}},
+        }
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, endpoints=endpoints
+            )
+        )
+        # URIs equal to the primary's are omitted and the given endpoints are kept as-is:
+        payload = json.loads(rel_data[legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY])
+        self.assertEqual(
+            payload["endpoints"],
+            {
+                "primary": {"uri": "testuri"},
+                "read": {"options": {"readPreference": "nearest"}},
+                "analytics": {"options": {"readPreference": "secondaryPreferred"}},
+            },
+        )
+        self.assertEqual(endpoints["read"]["uri"], "testuri")
+
+        # Setting the same endpoints with an explicit URI is not a change:
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data,
+                creds,
+                endpoints={
+                    "read": {"options": {"readPreference": "nearest"}},
+                    "analytics": {
+                        "uri": "testuri",
+                        "options": {"readPreference": "secondaryPreferred"},
+                    },
+                },
+            )
+        )
+        self.assertEqual(rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY], "1")
+
+    def test_set_legend_database_payload_version_switching(self):
+        creds = {
+            "uri": "testuri",
+            "username": "testuser",
+            "password": "testpass",
+            "database": "testdb",
+        }
+        rel_data = {}
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(rel_data, creds)
+        )
+        self.assertEqual(rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY], "1")
+
+        # Switching to v0 removes both the payload and its revision:
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data, creds, version=0
+            )
+        )
+        self.assertEqual(
+            rel_data, {legend_database.LEGEND_DB_RELATION_DATA_KEY: json.dumps(creds)}
+        )
+
+        # Switching back to v1 removes the v0 creds and restarts the revision:
+        creds["password"] = "newpass"
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(rel_data, creds)
+        )
+        self.assertEqual(
+            set(rel_data),
+            {
+                legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY,
+                legend_database.LEGEND_DB_RELATION_REVISION_KEY,
+            },
+        )
+        self.assertEqual(rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY], "1")
+        payload = json.loads(rel_data[legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY])
+        self.assertEqual(payload["revision"], 1)
+        self.assertEqual(payload["password"], "newpass")
+
+    def test_publish_supported_payload_versions(self):
+        self.harness.set_leader()
+        self.harness.begin_with_initial_hooks()
+        rel_id = self._add_db_relation("test_relator", {})
+
+        rel_data = self.harness.get_relation_data(rel_id, self.harness.charm.app.name)
+        self.assertEqual(
+            json.loads(rel_data[legend_database.LEGEND_DB_RELATION_VERSIONS_KEY]),
+            legend_database.SUPPORTED_LEGEND_DB_PAYLOAD_VERSIONS,
+        )
+        self.assertEqual(legend_database.get_negotiated_payload_version(rel_data), 1)
+
+    def test_get_legend_payload(self):
+        rel_data = {}
+        creds = {
+            "uri": "testuri",
+            "username": "testuser",
+            "password": "testpass",
+            "database": "testdb",
+        }
+        self.assertTrue(
+            legend_database.set_legend_database_payload_in_relation_data(
+                rel_data,
+                creds,
+                endpoints={
+                    "read": {"options": {"readPreference": "nearest"}},
+                    "analytics": {"uri": "analyticsuri"},
+                },
+            )
+        )
+        rel_id = self._add_db_relation("test_relator", rel_data)
+        self.harness.begin_with_initial_hooks()
+        consumer = self.harness.charm.legend_db_consumer
+
+        self.assertEqual(consumer.get_legend_database_revision(rel_id), 1)
+        payload = consumer.get_legend_database_payload(rel_id)
+        self.assertEqual(payload["version"], legend_database.LEGEND_DB_PAYLOAD_VERSION)
+        self.assertEqual(
+            payload["endpoints"],
+            {
+                "primary": {"uri": "testuri"},
+                # NOTE: inherited URIs are filled in for consumers:
+                "read": {"uri": "testuri", "options": {"readPreference": "nearest"}},
+                "analytics": {"uri": "analyticsuri"},
+            },
+        )
+        # The creds are derived from the payload's primary endpoint:
+        self.assertNotIn(legend_database.LEGEND_DB_RELATION_DATA_KEY, rel_data)
+        self.assertEqual(consumer.get_legend_database_creds(rel_id), creds)
+
+    def test_get_legend_payload_fallback(self):
+        creds = {
+            "uri": "testuri",
+            "username": "testuser",
+            "password": "testpass",
+            "database": "testdb",
+        }
+        expected_payload = {
+            "version": 0,
+            "revision": 0,
+            "username": "testuser",
+            "password": "testpass",
+            "database": "testdb",
+            "endpoints": {"primary": {"uri": "testuri"}},
+            "options": {},
+        }
+
+        # Provider only setting the v0 creds:
+        rel_data = {}
+        self.assertTrue(
+            legend_database.set_legend_database_creds_in_relation_data(rel_data, creds)
+        )
+        # Provider setting a payload version unknown to the consumer alongside the v0 creds:
+        future_rel_data = dict(rel_data)
+        future_rel_data[legend_database.LEGEND_DB_RELATION_PAYLOAD_KEY] = json.dumps(
+            dict(expected_payload, version=legend_database.LEGEND_DB_PAYLOAD_VERSION + 1)
+        )
+        future_rel_data[legend_database.LEGEND_DB_RELATION_REVISION_KEY] = "3"
+
+        rel_id = self._add_db_relation("test_relator", rel_data)
+        future_rel_id = self._add_db_relation("future_relator", future_rel_data)
+        self.harness.begin_with_initial_hooks()
+        consumer = self.harness.charm.legend_db_consumer
+
+        self.assertIsNone(consumer.get_legend_database_revision(rel_id))
+        self.assertEqual(consumer.get_legend_database_payload(rel_id), expected_payload)
+        self.assertEqual(consumer.get_legend_database_payload(future_rel_id), expected_payload)
+        self.assertEqual(consumer.get_legend_database_creds(future_rel_id), creds)